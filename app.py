@@ -4,6 +4,36 @@ import pandas as pd
 import re
 import io
 import os
+import functools
+import collections
+
+# --- Compiled Patterns ---
+
+_RE_HS = re.compile(r'H\.?S\.?\s*(\d{8})')
+_RE_PO = re.compile(r'REF\s+(PO-[\w\d\-]+)(?:.*?(\d{2}/\d{2}/\d{2}))?')
+_RE_WEIGHT = re.compile(r'(\d{8})\s+([\d\.]+,\d+)\s+[\d\.]+,\d+')
+_RE_INV = re.compile(r'(?:FATTURA|INVOICE)\s+(\d{4}/[A-Z]{2}/\d+).*DATE\s+(\d{2}/\d{2}/\d{2})')
+_RE_CURR = re.compile(r'TOTAL AMOUNT\s+([A-Z]{3})')
+# Order confirmation line: more than 8 chars, starting "OC" + digit; captures the first token
+_RE_OC = re.compile(r'^(?=.{9})(OC\d\S*)')
+
+# Any line the main pass can act on: a leading token with a digit (item / OC codes)
+# or one of the header, PO, HS and transaction markers. Everything else is skipped.
+_LINE_CLASSIFIER = re.compile(r'^\S*\d| PZ |H\.?S|REF PO-|INVOICE N\.')
+
+# Drops thousands separators, the USD marker and spaces; decimal comma -> point
+_DEC_TABLE = str.maketrans({'.': '', ',': '.', 'U': '', 'S': '', 'D': '', ' ': ''})
+
+# Fields of each extracted invoice row, in output order
+_ROW_FIELDS = (
+    "Inv No.", "Inv Date", "Supplier Name",
+    "Order confirmation number",
+    "PO No", "PO Date",
+    "ItemCode", "Item Desc",
+    "Currency",
+    "Qty", "Price", "Discount", "Amount", "VAT", "HSCode",
+    "Unit Weight", "Total Weight"
+)
 
 # --- Helper Functions ---
 
@@ -12,13 +42,12 @@ def parse_decimal(num_str):
     Converts European format string (1.000,00) to Python Float.
     """
     if not num_str: return 0.0
-    clean = num_str.replace('USD', '').strip()
-    clean = clean.replace('.', '').replace(',', '.')
     try:
-        return float(clean)
-    except:
+        return float(num_str.translate(_DEC_TABLE))
+    except ValueError:
         return 0.0
 
+@functools.lru_cache(maxsize=4096)
 def is_item_code(word):
     """
     Checks if a word looks like an Item Code.
@@ -40,12 +69,52 @@ def is_item_code(word):
     # Must contain at least one digit
     has_digit = any(char.isdigit() for char in word)
     
-    # Exclude dates
-    if re.match(r'\d{2}/\d{2}/\d{2}', word):
+    # Exclude dates (dd/mm/yy...)
+    if (len(word) >= 8 and word[2] == '/' and word[5] == '/'
+            and word[:2].isdigit() and word[3:5].isdigit() and word[6:8].isdigit()):
         return False
 
     return has_digit
 
+@st.cache_data(show_spinner=False)
+def _load_master(master_file, mtime):
+    """
+    Reads the Item Master CSV and returns the columns used for enrichment,
+    renamed to our field names and indexed by ItemCode.
+    Returns None if 'VIR Item Code' is missing.
+    Cached across reruns; 'mtime' invalidates the cache when the file changes.
+    """
+    # Read CSV (Try common encodings)
+    # Fig/Size are read as text so numeric values don't come back as floats (200 -> 200.0)
+    text_cols = {"Fig. Number": str, "Size - mm": str}
+    try:
+        df_master = pd.read_csv(master_file, encoding='utf-8', dtype=text_cols)
+    except UnicodeDecodeError:
+        df_master = pd.read_csv(master_file, encoding='cp1252', dtype=text_cols)
+    
+    # Define Mapping from CSV Headers to Our Requirements
+    col_mapping = {
+        "VIR Item Code": "ItemCode",
+        "Fig. Number": "Fig No",
+        "Size - mm": "Size MM",
+        "Product Category": "Product Category",
+        "Origin": "Origin",
+        "Description": "Master_Desc"
+    }
+
+    if "VIR Item Code" not in df_master.columns:
+        return None
+
+    # Rename columns
+    df_master = df_master.rename(columns=col_mapping)
+    
+    # Select relevant columns
+    desired_fields = ["ItemCode", "Fig No", "Size MM", "Product Category", "Origin", "Master_Desc"]
+    available_fields = [c for c in desired_fields if c in df_master.columns]
+    
+    # Indexed by ItemCode for lookups; the first entry wins if a code is listed twice
+    return df_master[available_fields].drop_duplicates("ItemCode").set_index("ItemCode")
+
 def load_and_enrich_data(df):
     """
     Loads 'Item Master.csv' and merges it with the extracted PDF data.
@@ -63,97 +132,65 @@ def load_and_enrich_data(df):
         return df
 
     try:
-        # 2. Read CSV (Try common encodings)
-        try:
-            df_master = pd.read_csv(master_file, encoding='utf-8')
-        except UnicodeDecodeError:
-            df_master = pd.read_csv(master_file, encoding='cp1252')
-        
-        # 3. Define Mapping from CSV Headers to Our Requirements
-        col_mapping = {
-            "VIR Item Code": "ItemCode",
-            "Fig. Number": "Fig No",
-            "Size - mm": "Size MM",
-            "Product Category": "Product Category",
-            "Origin": "Origin",
-            "Description": "Master_Desc"
-        }
-
-        if "VIR Item Code" not in df_master.columns:
+        # 2. Read CSV (cached across reruns until the file changes)
+        df_master_subset = _load_master(master_file, os.path.getmtime(master_file))
+
+        if df_master_subset is None:
             st.warning("Found 'Item Master.csv' but could not find 'VIR Item Code' column.")
             return df
 
-        # Rename columns
-        df_master = df_master.rename(columns=col_mapping)
-        
-        # Select relevant columns
-        desired_fields = ["ItemCode", "Fig No", "Size MM", "Product Category", "Origin", "Master_Desc"]
-        available_fields = [c for c in desired_fields if c in df_master.columns]
+        # 3. Look up Master fields by ItemCode (Left Join)
+        for c in df_master_subset.columns:
+            df[c] = df["ItemCode"].map(df_master_subset[c])
         
-        df_master_subset = df_master[available_fields].copy()
-
-        # 4. Merge Data (Left Join)
-        df_merged = pd.merge(df, df_master_subset, on="ItemCode", how="left")
-        
-        # 5. Logic: Use Master Description if available
-        if "Master_Desc" in df_merged.columns:
-            df_merged["Item Desc"] = df_merged["Master_Desc"].fillna(df_merged["Item Desc"])
-            df_merged = df_merged.drop(columns=["Master_Desc"])
+        # 4. Logic: Use Master Description if available
+        if "Master_Desc" in df.columns:
+            df["Item Desc"] = df["Master_Desc"].fillna(df["Item Desc"])
+            df = df.drop(columns=["Master_Desc"])
             
-        # 6. --- NEW LOGIC: Calculate Lot No ---
+        # 5. --- NEW LOGIC: Calculate Lot No ---
         
-        # Ensure Fig No and Size MM are strings and clean up float decimals (e.g. 200.0 -> 200)
+        # Ensure Fig No and Size MM are strings
         # We handle cases where columns might not exist or are NaN
-        if "Fig No" in df_merged.columns:
-            df_merged["Fig No"] = df_merged["Fig No"].fillna("").astype(str).str.replace(r'\.0$', '', regex=True)
+        if "Fig No" in df.columns:
+            df["Fig No"] = df["Fig No"].fillna("").astype(str)
         else:
-            df_merged["Fig No"] = ""
+            df["Fig No"] = ""
 
-        if "Size MM" in df_merged.columns:
-            df_merged["Size MM"] = df_merged["Size MM"].fillna("").astype(str).str.replace(r'\.0$', '', regex=True)
+        if "Size MM" in df.columns:
+            df["Size MM"] = df["Size MM"].fillna("").astype(str)
         else:
-            df_merged["Size MM"] = ""
+            df["Size MM"] = ""
             
-        def calculate_lot(row):
-            fig = row.get("Fig No", "").strip()
-            size = row.get("Size MM", "").strip()
-            # If both exist, combine them
-            if fig and size:
-                return f"{fig}-{size}"
-            return ""
+        # If both exist, combine them
+        fig = df["Fig No"].str.strip()
+        size = df["Size MM"].str.strip()
+        df["Lot No"] = (fig + "-" + size).where((fig != "") & (size != ""), "")
 
-        df_merged["Lot No"] = df_merged.apply(calculate_lot, axis=1)
-
-        # 7. Fill remaining missing columns (Category, Origin)
+        # 6. Fill remaining missing columns (Category, Origin)
         for c in ["Product Category", "Origin"]:
-            if c in df_merged.columns:
-                df_merged[c] = df_merged[c].fillna("")
+            if c in df.columns:
+                df[c] = df[c].fillna("")
             else:
-                df_merged[c] = ""
+                df[c] = ""
                 
-        return df_merged
+        return df
 
     except Exception as e:
         st.warning(f"Error reading Item Master file: {e}")
         return df
 
-def calculate_weights(df, hs_weight_map):
+def calculate_weights(df, hs_weight_map, hs_qty_sum):
     """
     Calculates 'Unit Weight' and 'Total Weight'.
+    hs_qty_sum holds the total Qty per HS code, accumulated while parsing.
     """
     if df.empty:
         return df
         
-    hs_qty_sum = df.groupby("HSCode")["Qty"].sum().to_dict()
-    
-    def get_unit_weight(row):
-        hs_code = row["HSCode"]
-        total_summary_weight = hs_weight_map.get(hs_code, 0.0)
-        total_hs_qty = hs_qty_sum.get(hs_code, 1.0) 
-        if total_hs_qty == 0: return 0.0
-        return total_summary_weight / total_hs_qty
-
-    df["Unit Weight"] = df.apply(get_unit_weight, axis=1)
+    total_summary_weight = df["HSCode"].map(hs_weight_map).fillna(0.0)
+    total_hs_qty = df["HSCode"].map(hs_qty_sum)
+    df["Unit Weight"] = (total_summary_weight / total_hs_qty).where(total_hs_qty != 0, 0.0)
     df["Total Weight"] = df["Qty"] * df["Unit Weight"]
     
     return df
@@ -171,20 +208,15 @@ def merge_similar_items(df):
         "Price"
     ]
     
-    agg_dict = {
-        "Qty": "sum",
-        "Amount": "sum",
-        "Total Weight": "sum"
-    }
+    sum_cols = ["Qty", "Amount", "Total Weight"]
     
-    for col in df.columns:
-        if col not in group_cols and col not in agg_dict:
-            agg_dict[col] = "first"
-
-    df_merged = df.groupby(group_cols, as_index=False).agg(agg_dict)
+    # Other columns keep their first value: take the first row of each group and
+    # overwrite the summed columns (sort=False keeps groups in first-seen order)
+    sums = df.groupby(group_cols, sort=False, dropna=False)[sum_cols].sum()
+    df_merged = df.drop_duplicates(group_cols).copy()
+    df_merged[sum_cols] = sums.to_numpy()
     
-    desired_cols = [c for c in df.columns if c in df_merged.columns]
-    return df_merged[desired_cols]
+    return df_merged.sort_values(group_cols, ignore_index=True)
 
 def process_pdf(uploaded_file):
     """
@@ -204,32 +236,31 @@ def process_pdf(uploaded_file):
     current_hs_code = "" 
     
     pending_row = None
-    extracted_rows = []
-    hs_weight_map = {} 
+    extracted_cols = {k: [] for k in _ROW_FIELDS}
+    hs_qty_sum = collections.defaultdict(float)
 
     with pdfplumber.open(uploaded_file) as pdf:
-        total_pages = len(pdf.pages)
+        # Extract each page's text once; every pass below reuses it, so the
+        # pre-passes need no extra extraction (extract_words would redo the same char work).
+        # Closing the page afterwards frees its cached layout objects.
+        page_texts = []
+        for p in pdf.pages:
+            page_texts.append(p.extract_text() or "")
+            p.close()
 
         # PRE-PASS 1: WEIGHTS (Scan ALL pages)
-        for p in pdf.pages:
-            text = p.extract_text()
-            if not text: continue
-            
+        # Matched per page so a match can't span a page boundary
+        hs_weight_map = {}
+        for text in page_texts:
             # Matches line like: 40169991 8,95 74,40
-            weight_matches = re.findall(r'(\d{8})\s+([\d\.]+,\d+)\s+[\d\.]+,\d+', text)
-            for code, weight_str in weight_matches:
+            for code, weight_str in _RE_WEIGHT.findall(text):
                 hs_weight_map[code] = parse_decimal(weight_str)
 
         # PRE-PASS 2: CURRENCY (Scan last 2 pages)
-        pages_to_scan_currency = [pdf.pages[-1]]
-        if total_pages > 1:
-            pages_to_scan_currency.insert(0, pdf.pages[-2])
-            
-        for p in pages_to_scan_currency:
-            text = p.extract_text()
+        for text in page_texts[-2:]:
             if not text: continue
             
-            curr_match = re.search(r'TOTAL AMOUNT\s+([A-Z]{3})', text)
+            curr_match = _RE_CURR.search(text)
             if curr_match:
                 currency = curr_match.group(1)
                 break
@@ -239,36 +270,35 @@ def process_pdf(uploaded_file):
                 currency = "EUR"
 
         # MAIN PASS
-        for i, page in enumerate(pdf.pages):
-            text = page.extract_text()
+        for i, text in enumerate(page_texts):
             if not text: continue
             
-            lines = text.split('\n')
-            
-            for line in lines:
+            for line in text.split('\n'):
                 line = line.strip()
+                if not _LINE_CLASSIFIER.search(line): continue
                 
                 # Header Extraction
                 if i == 0 and "INVOICE N." in line:
-                    match = re.search(r'(?:FATTURA|INVOICE)\s+(\d{4}/[A-Z]{2}/\d+).*DATE\s+(\d{2}/\d{2}/\d{2})', line)
+                    match = _RE_INV.search(line)
                     if match:
                         invoice_no = match.group(1)
                         invoice_date = match.group(2)
                 
                 # Capture Data
-                if line.startswith("OC") and len(line) > 8 and line[2].isdigit():
-                    current_oc = line.split()[0]
+                oc_match = _RE_OC.match(line)
+                if oc_match:
+                    current_oc = oc_match.group(1)
                 
                 # Flexible PO Date Extraction
                 if "REF PO-" in line:
-                    po_match = re.search(r'REF\s+(PO-[\w\d\-]+)(?:.*?(\d{2}/\d{2}/\d{2}))?', line)
+                    po_match = _RE_PO.search(line)
                     if po_match:
                         current_po = po_match.group(1)
                         if po_match.group(2):
                             current_po_date = po_match.group(2)
 
-                if "H.S" in line or "HS" in line:
-                    hs_match = re.search(r'H\.?S\.?\s*(\d{8})', line)
+                if "HS" in line or "H.S" in line:
+                    hs_match = _RE_HS.search(line)
                     if hs_match:
                         found_hs = hs_match.group(1)
                         current_hs_code = found_hs
@@ -280,10 +310,12 @@ def process_pdf(uploaded_file):
                     if words and is_item_code(words[0]):
                         current_item_code = words[0]
 
-                # Transaction Line
-                if " PZ " in line:
+                else:
+                    # Transaction Line
                     if pending_row:
-                        extracted_rows.append(pending_row)
+                        for k, v in pending_row.items():
+                            extracted_cols[k].append(v)
+                        hs_qty_sum[pending_row["HSCode"]] += pending_row["Qty"]
                         pending_row = None
 
                     try:
@@ -302,7 +334,6 @@ def process_pdf(uploaded_file):
                         amount_str = math_tokens[-1]
                         price_str = math_tokens[-2] if len(math_tokens) >= 2 else "0"
                         qty_str = math_tokens[0] if len(math_tokens) >= 1 else "0"
-                        discount_str = "0"
                         
                         pending_row = {
                             "Inv No.": invoice_no,
@@ -316,7 +347,7 @@ def process_pdf(uploaded_file):
                             "Currency": currency,
                             "Qty": parse_decimal(qty_str),
                             "Price": parse_decimal(price_str),
-                            "Discount": parse_decimal(discount_str),
+                            "Discount": 0.0,
                             "Amount": parse_decimal(amount_str),
                             "VAT": "", 
                             "HSCode": current_hs_code, 
@@ -327,13 +358,15 @@ def process_pdf(uploaded_file):
                         continue
 
     if pending_row:
-        extracted_rows.append(pending_row)
+        for k, v in pending_row.items():
+            extracted_cols[k].append(v)
+        hs_qty_sum[pending_row["HSCode"]] += pending_row["Qty"]
 
-    # Create DataFrame
-    df = pd.DataFrame(extracted_rows)
+    # Create DataFrame (column lists, no row-to-column transpose)
+    df = pd.DataFrame(extracted_cols, copy=False)
     
     # 1. Calculate Weights
-    df = calculate_weights(df, hs_weight_map)
+    df = calculate_weights(df, hs_weight_map, dict(hs_qty_sum))
     
     # 2. Enrich with Master Data (CSV)
     df = load_and_enrich_data(df)
@@ -358,7 +391,7 @@ def to_excel(df):
     Converts dataframe to Excel bytes with a TOTALS row.
     """
     output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
         
         # Calculate Totals
         total_qty = df['Qty'].sum()